@@ -1,16 +1,34 @@
 #!/usr/bin/env python
 import sys
 import os
-import optparse
+import argparse
 import csv
 import datetime
+import urllib.parse
 import dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Decode API responses with orjson when available, it is a few times faster
+# than the stdlib parser; fall back to json so it stays a soft dependency.
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 dotenv.load_dotenv(dotenv_path)
 
 TEX_API_KEY = os.environ.get("TEX_API_KEY")
+if not TEX_API_KEY:
+    sys.exit("TEX_API_KEY not set, create a .env file with the API key")
+
+# Pre-encoded once so urllib3 does not re-encode the header every request
+AUTH_HEADERS = {'Authorization': TEX_API_KEY.encode('ascii')}
+TEX_API_URL = 'https://threatexplorer.symantec.com/api/v1/url'
 SUPPORTED_THREAT_TYPES = ['IP Address', 'Domain', 'URL']
 MIN_BLOCKED_RISK_LEVEL = 8
 
@@ -102,22 +120,59 @@ MIN_BLOCKED_RISK_LEVEL = 8
 # 118 Piracy/Copyright Concerns
 # 121 Marijuana
 
-BLOCKED_CATEGORY_IDS = [17, 18, 43, 44]
+BLOCKED_CATEGORY_IDS = frozenset({17, 18, 43, 44})
+
+# Reuse one session so the urllib3 pool keeps the TLS connection to the API
+# alive between lookups instead of doing a handshake per IOC.
+SESSION = requests.Session()
+SESSION.headers.update(AUTH_HEADERS)
+SESSION.mount('https://', HTTPAdapter(
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 502, 503, 504],
+                      raise_on_status=False)))
+
 
+class LazyCSVWriter:
+    """Create the output file and write the header on the first row, so a
+    run without matching rows leaves no empty file behind"""
 
-def rlcheck(ioc):
-    auth_headers = {'Authorization': TEX_API_KEY}
-    tex_api_url = 'https://threatexplorer.symantec.com/api/v1/url' + \
-                  '?level=STANDARD&url='
-    response = requests.get(tex_api_url + ioc, headers=auth_headers)
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+        self.filewriter = None
+        self.csvwriter = None
 
+    def writerow(self, row):
+        if self.csvwriter is None:
+            self.filewriter = open(self.filename, "w", newline='')
+            self.csvwriter = csv.writer(self.filewriter)
+            self.csvwriter.writerow(self.header)
+        self.csvwriter.writerow(row)
+
+    def close(self):
+        if self.filewriter is not None:
+            self.filewriter.close()
+
+
+def rlcheck(ioc_q):
     ret = dict()
 
+    # The indicator is percent-encoded by the caller, so the URL can be
+    # assembled with a plain f-string. Timeouts, connection errors and
+    # exhausted retries end up in the error file instead of crashing the run.
+    try:
+        response = SESSION.get(f"{TEX_API_URL}?level=STANDARD&url={ioc_q}",
+                               timeout=(3, 10))
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed: {e}")
+        ret['error'] = e
+        return ret
+
     if (response.status_code == 200):
         ret['error'] = 0
         ret['blocked'] = 0
         ret['category'] = []
-        data = response.json()
+        data = _loads(response.content)
 
         if "categorization" in data and "categories" in data["categorization"]:
             categories = data["categorization"]["categories"]
@@ -145,26 +200,28 @@ def rlcheck(ioc):
     elif response.status_code == 429:
         print("API Limit reached")
         ret['error'] = 429
+    else:
+        # raise_on_status=False hands back the final response when the
+        # retries are exhausted on a 5xx, so record it like the other errors
+        print(f"API error {response.status_code}")
+        ret['error'] = response.status_code
 
     return ret
 
 
 def main(argv=sys.argv):
-    p = optparse.OptionParser(
+    p = argparse.ArgumentParser(
         description='Check risk level for URL, IP and \
             Domain to exclude already blocked items in the Proxy/WSS Policy',
-        prog='rlcheck',
-        version='0.1',
-        usage='%prog <input file>')
-    p.add_option('--output-dir', '-f', dest="out", help="Output directory")
-    p.set_default("out", "output")
-
-    options, arguments = p.parse_args()
+        prog='rlcheck')
+    p.add_argument('--version', action='version', version='%(prog)s 0.1')
+    p.add_argument('--output-dir', '-f', dest="out", default="output",
+                   help="Output directory")
+    p.add_argument('inputfile', help="CSV file with IOC's to check")
 
-    if len(arguments) != 1:
-        p.error("Incorrect arguments")
+    options = p.parse_args()
 
-    fname = arguments[0]
+    fname = options.inputfile
     if not os.path.exists(fname):
         sys.exit("Invalid input file")
 
@@ -181,29 +238,37 @@ def main(argv=sys.argv):
     outputfile_error = os.path.join(
         outpath, ts + '_' + os.path.basename(fname) + '_error')
 
-    with open(fname) as csv_file, \
-            open(outputfile_blocked, "w") as output_blocked, \
-            open(outputfile_policy, "w") as output_policy, \
-            open(outputfile_error, "w") as output_error:
-        csv_reader = csv.DictReader(csv_file)
-        line_count = 0
+    with open(fname, buffering=1 << 20, newline='') as csv_file:
+        # Rows are handled as plain lists with fixed column indices so the
+        # C-accelerated csv reader/writer is used instead of the dict wrappers
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader, None)
+
+        if header is None or 'Indicator' not in header:
+            sys.exit(f"Unable to find the column Indicator in {fname}")
+        if 'ThreatType' not in header:
+            sys.exit(f"Unable to find the column ThreatType in {fname}")
+        idx_indicator = header.index('Indicator')
+        idx_threattype = header.index('ThreatType')
+
+        # The output files are only created when their first row arrives
+        csv_blocked = LazyCSVWriter(outputfile_blocked, header)
+        csv_policy = LazyCSVWriter(outputfile_policy, header)
+        csv_error = LazyCSVWriter(outputfile_error, header)
+
         blocked_count = 0
         policy_count = 0
         error_count = 0
 
         for row in csv_reader:
-            if line_count == 0:
-                csv_blocked = csv.DictWriter(output_blocked, fieldnames=row)
-                csv_blocked.writeheader()
-                csv_policy = csv.DictWriter(output_policy, fieldnames=row)
-                csv_policy.writeheader()
-                csv_error = csv.DictWriter(output_error, fieldnames=row)
-                csv_error.writeheader()
-                line_count += 1
-
-            if row['ThreatType'] in SUPPORTED_THREAT_TYPES:
-                print(f'{row["ThreatType"]}: {row["Indicator"]}')
-                ret = rlcheck(row["Indicator"])
+            # csv.reader yields [] for blank lines (DictReader used to skip
+            # them); drop rows too short to hold the required columns
+            if len(row) <= max(idx_indicator, idx_threattype):
+                continue
+            if row[idx_threattype] in SUPPORTED_THREAT_TYPES:
+                print(f'{row[idx_threattype]}: {row[idx_indicator]}')
+                ret = rlcheck(urllib.parse.quote(row[idx_indicator],
+                                                 safe=''))
                 if ret['error'] == 0 and ret['blocked'] == 1:
                     print(f'Blocked: {ret["blocked"]}, RL: {ret["risklevel"]}')
                     csv_blocked.writerow(row)
@@ -217,14 +282,9 @@ def main(argv=sys.argv):
                     csv_error.writerow(row)
                     error_count += 1
 
-    if blocked_count == 0:
-        os.remove(outputfile_blocked)
-
-    if policy_count == 0:
-        os.remove(outputfile_policy)
-
-    if error_count == 0:
-        os.remove(outputfile_error)
+        csv_blocked.close()
+        csv_policy.close()
+        csv_error.close()
 
     print(f'Blocked: { blocked_count}, Policy: { policy_count }' +
           f', Error { error_count}')
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+
+""" Determine which IOC's are blocked by Broadcom already to understand which
+IOC's need to be added to the policy to avoid large custom policies.
+
+Asyncio variant of rlcheckmt.py: instead of N OS threads doing blocking
+requests, a single event loop runs the lookup tasks on one httpx client
+with HTTP/2 enabled, so many in-flight lookups are multiplexed over a
+single TLS connection (falling back to HTTP/1.1 keep-alive when the server
+does not negotiate h2) at a fraction of the RAM/CPU of threads.
+
+The input CSV file needs to contain the field Indicator and ThreatType for
+this script to function!
+
+Installation:
+
+  1. Create virtual env: python -m venv venv
+  2. Activate venv
+  3. Install requirements (pip install -r requirements.txt)
+  4. create .env file with TEX_API_KEY key that holds the API key
+  5. Create output folder (mkdir output)
+  6. Run, with venv activated, python rlcheckaio.py <inputfile>
+  7. See on screen updates and output in output folder.
+
+"""
+__author__ = "Henk van Achterberg, PM Threat Intelligence, Broadcom"
+__copyright__ = "Copyright 2021, Henk van Achterberg"
+__credits__ = ["Henk van Achterberg"]
+__license__ = "GPL"
+__version__ = "0.9"
+__maintainer__ = "Henk van Achterberg"
+__email__ = "henk.vanachterberg@broadcom.com"
+__status__ = "Development"
+
+import sys
+import os
+import argparse
+import csv
+import datetime
+import urllib.parse
+import asyncio
+import time
+import random
+from collections import OrderedDict
+import dotenv
+import httpx
+
+# Decode API responses with orjson when available, it is a few times faster
+# than the stdlib parser; fall back to json so it stays a soft dependency.
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+# ------------------------ Application variables ---------------------------- #
+
+# Use dotenv to save the API key in ".env" file under the key TEX_API_KEY
+
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+dotenv.load_dotenv(dotenv_path)
+
+TEX_API_KEY = os.environ.get("TEX_API_KEY")
+if not TEX_API_KEY:
+    sys.exit("TEX_API_KEY not set, create a .env file with the API key")
+
+# Pre-encoded once so the client does not re-encode the header per request
+AUTH_HEADERS = {'Authorization': TEX_API_KEY.encode('ascii')}
+
+# API endpoint, indicators are percent-encoded before lookup so the
+# request URL is assembled with a plain f-string
+TEX_API_URL = 'https://threatexplorer.symantec.com/api/v1/url'
+
+# Threat types that are supported to look up with the API, non supported
+# threat types will go in to the error file.
+SUPPORTED_THREAT_TYPES = ['IP Address', 'Domain', 'URL']
+
+# Minimum threat level blocked in the WSS/ProxySG policy
+MIN_BLOCKED_RISK_LEVEL = 8
+
+# Client side rate limiting, requests per second and how often a lookup that
+# hit the API limit (HTTP 429) is retried before it goes to the error file.
+MAX_REQUESTS_PER_SECOND = 10
+MAX_RETRIES_429 = 5
+BACKOFF_BASE = 0.5
+
+# Feeds often repeat indicators. Completed lookups are kept for
+# RESULT_CACHE_TTL seconds (bounded to RESULT_CACHE_MAX entries) and a
+# duplicate that arrives while the first lookup is still in flight piggybacks
+# on that request, so no indicator costs a second API call or quota.
+RESULT_CACHE_TTL = 3600
+RESULT_CACHE_MAX = 10000
+
+# Categories that ar blocked by the policy, see rlcheckmt.py for the full
+# category id/name reference list.
+BLOCKED_CATEGORY_IDS = frozenset({17, 18, 43, 44})
+
+# ----------------------------- Helper classes ------------------------------ #
+
+
+class RateLimiter:
+    """Token bucket that paces API calls and backs off on HTTP 429"""
+
+    def __init__(self, *args):
+        self.rate = float(args[0])
+        self.capacity = float(args[0])
+        self.tokens = float(args[0])
+        self.timestamp = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        """Suspend the calling task until a token is available"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def backoff(self, seconds):
+        """Pause all callers, used when the API reports its limit reached"""
+        self.paused_until = max(self.paused_until,
+                                time.monotonic() + seconds)
+
+
+class AsyncCSVWriter:
+    """Write CSV files trough an asyncio queue"""
+
+    def __init__(self, *args):
+        self.filewriter = open(args[0], args[2],
+                               newline='', encoding="utf-8-sig")
+        self.csvwriter = csv.DictWriter(self.filewriter, fieldnames=args[1],
+                                        dialect='excel', delimiter=";")
+        self.csvwriter.writeheader()
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.internal_writer())
+
+    def write(self, data):
+        self.queue.put_nowait(data)
+
+    async def internal_writer(self):
+        while True:
+            data = await self.queue.get()
+            if data is None:
+                break
+            self.csvwriter.writerow(data)
+            self.queue.task_done()
+
+    async def close(self):
+        self.queue.put_nowait(None)
+        await self.task
+        self.filewriter.close()
+
+
+class IOCStat:
+    """Keep counters and redraw the status line every update_interval"""
+
+    def __init__(self, *args):
+        self.ioc_blocked = 0
+        self.ioc_policy = 0
+        self.ioc_error = 0
+        self.ioc_total = 0
+        self.printed_stat = 1
+        self.update_interval = args[0]
+        self.task = asyncio.ensure_future(self.stat_keeper())
+
+    def update(self, data):
+        if data['type'] == 'blocked':
+            self.ioc_blocked += 1
+        elif data['type'] == 'policy':
+            self.ioc_policy += 1
+        elif data['type'] == 'error':
+            self.ioc_error += 1
+        self.ioc_total += 1
+
+    def stats(self):
+        ret = dict()
+        ret['ioc_total'] = self.ioc_total
+        ret['ioc_blocked'] = self.ioc_blocked
+        ret['ioc_policy'] = self.ioc_policy
+        ret['ioc_error'] = self.ioc_error
+        return ret
+
+    async def stat_keeper(self):
+        # Only redraw the status line when the counters actually moved
+        last_total = -1
+        while True:
+            await asyncio.sleep(self.update_interval)
+            if self.ioc_total == last_total:
+                continue
+            last_total = self.ioc_total
+            sys.stdout.write(f"\r[{datetime.datetime.now()}] "
+                             f"Processed: {self.ioc_total}, "
+                             f"Blocked: {self.ioc_blocked}, "
+                             f"Policy: {self.ioc_policy}, "
+                             f"Error: {self.ioc_error}")
+            sys.stdout.flush()
+            self.printed_stat = 1
+
+    def close(self):
+        self.task.cancel()
+
+
+def log(message):
+    ts = datetime.datetime.now()
+    print(f"[{ts}] {message}")
+
+
+RATE_LIMITER = RateLimiter(MAX_REQUESTS_PER_SECOND)
+
+
+_INFLIGHT = {}
+_RESULTS = OrderedDict()
+
+
+async def rlcheck(session, ioc):
+    """Look up an IOC, coalescing duplicates and caching recent results"""
+
+    cached = _RESULTS.get(ioc)
+    if (cached is not None and
+            time.monotonic() - cached[0] < RESULT_CACHE_TTL):
+        return cached[1]
+
+    fut = _INFLIGHT.get(ioc)
+    if fut is not None:
+        # Another task is already looking this IOC up, wait for its result
+        return await fut
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[ioc] = fut
+    try:
+        ret = await _do_rlcheck(session, ioc)
+    except BaseException as e:
+        _INFLIGHT.pop(ioc, None)
+        fut.set_exception(e)
+        raise
+
+    # Only successful lookups are memoized, an error (timeout, exhausted
+    # 429) must not fail later duplicates straight from cache
+    if ret['error'] == 0:
+        _RESULTS[ioc] = (time.monotonic(), ret)
+        while len(_RESULTS) > RESULT_CACHE_MAX:
+            _RESULTS.popitem(last=False)
+    _INFLIGHT.pop(ioc, None)
+    fut.set_result(ret)
+    return ret
+
+
+async def _do_rlcheck(session, ioc):
+    """Return risklevel, categories and if it is blocked by policy"""
+
+    # Initialize return object
+    ret = dict()
+    ret['error'] = 0
+    ret['blocked'] = 0
+    ret['risklevel'] = 0
+    ret['category'] = []
+
+    # Pace the request through the token bucket and retry 429 responses with
+    # exponential backoff and jitter instead of losing the IOC to the error
+    # file. The API's Retry-After header caps the backoff when present.
+    for attempt in range(MAX_RETRIES_429 + 1):
+        await RATE_LIMITER.acquire()
+        try:
+            response = await session.get(
+                f"{TEX_API_URL}?level=STANDARD&url={ioc}")
+        except httpx.HTTPError as e:
+            ret['error'] = e
+            return ret
+
+        if response.status_code == 200:
+            data = _loads(response.content)
+            break
+        elif response.status_code != 429:
+            ret['error'] = response.status_code
+            return ret
+
+        backoff = BACKOFF_BASE * 2 ** attempt + random.random()
+        retry_after = response.headers.get(
+            'Retry-After', response.headers.get('X-RateLimit-Reset'))
+        if retry_after is not None:
+            try:
+                backoff = min(float(retry_after), backoff)
+            except ValueError:
+                pass
+        RATE_LIMITER.backoff(backoff)
+    else:
+        ret['error'] = 429
+        return ret
+
+    if "categorization" in data and "categories" in data["categorization"]:
+        categories = data["categorization"]["categories"]
+
+        for cat in categories:
+            ret['category'].append(cat["name"])
+            if (cat["id"] in BLOCKED_CATEGORY_IDS):
+                ret['blocked'] = 1
+                ret['blocked_by_cat'] = 1
+
+    if "threatRiskLevel" in data and "level" in data["threatRiskLevel"]:
+        level = data["threatRiskLevel"]["level"]
+        ret['risklevel'] = level
+
+        if isinstance(level, int) and level >= MIN_BLOCKED_RISK_LEVEL:
+            ret['blocked'] = 1
+            ret['blocked_by_rl'] = 1
+        elif not isinstance(level, int):
+            ret['error'] = 'Risklevel not returned from API'
+
+    return ret
+
+
+async def do_work(session, item, csv_blocked, csv_policy, csv_error, stat):
+    """Look up IOC, augment with api data and write it to the correct file"""
+
+    # Percent-encode the indicator once up front; '?', '&', '#' or spaces
+    # would otherwise break or silently mis-address the API call
+    ioc_q = urllib.parse.quote(item["Indicator"], safe='')
+
+    # Anything rlcheck() does not handle itself (e.g. a JSON decode error on
+    # an HTML error page) must not kill the worker task, route it to the
+    # error file instead
+    try:
+        ret = await rlcheck(session, ioc_q)
+    except Exception as e:
+        ret = dict()
+        ret['error'] = e
+
+    if ret['error'] != 0:
+        if stat.printed_stat == 1:
+            print("")
+            stat.printed_stat = 0
+        log(f"Error {ret['error']} while processing {item['Indicator']}")
+        stat.update({'type': 'error'})
+        csv_error.write(item)
+    else:
+        item.update({'BC_RiskLevel': ret['risklevel'],
+                    'BC_Category': ', '.join(ret['category'])})
+        if ret['blocked'] == 1:
+            csv_blocked.write(item)
+            stat.update({'type': 'blocked'})
+        else:
+            csv_policy.write(item)
+            stat.update({'type': 'policy'})
+
+
+async def worker(session, q, csv_blocked, csv_policy, csv_error, stat):
+    """Process IOC from queue and start processing them"""
+    while True:
+        item = await q.get()
+        try:
+            await do_work(session, item,
+                          csv_blocked, csv_policy, csv_error, stat)
+        finally:
+            q.task_done()
+
+
+async def run(options, fname):
+    num_tasks = options.tasks
+    status_update_interval = options.interval
+
+    # Apply the requested rate limit to the shared token bucket
+    RATE_LIMITER.rate = options.rate
+    RATE_LIMITER.capacity = options.rate
+
+    # set output directory and set filenames
+    if options.out != 'output':
+        outpath = options.out
+    else:
+        outpath = os.path.join(os.getcwd(), options.out)
+
+    ts = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    outputfile_blocked = os.path.join(
+        outpath, ts + '_blocked' + '_' + os.path.basename(fname))
+    outputfile_policy = os.path.join(
+        outpath, ts + '_policy' + '_' + os.path.basename(fname))
+    outputfile_error = os.path.join(
+        outpath, ts + '_error' + '_' + os.path.basename(fname))
+
+    # Get fieldnames from the header line and add api return fields; reading
+    # the header directly also works for a file without data rows, where the
+    # old first-data-row probe left fieldnames unset
+    with open(fname, encoding='utf-8-sig') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader, None)
+
+        if header is None or 'Indicator' not in header:
+            log(f'Unable to find the column Indicator in {fname}')
+            return
+        if 'ThreatType' not in header:
+            log(f'Unable to find the column ThreatType in {fname}')
+            return
+        fieldnames = header + ['BC_RiskLevel', 'BC_Category']
+
+    # Count IOC's (minus header) by scanning the raw bytes for newlines
+    # instead of parsing the whole file through the csv module twice
+    ioccount = -1
+    with open(fname, 'rb') as rawfile:
+        for chunk in iter(lambda: rawfile.read(1 << 20), b''):
+            ioccount += chunk.count(b'\n')
+
+    log(f"Checking {ioccount} IOC's in {fname} "
+        f"with {num_tasks} tasks...")
+
+    csv_blocked = AsyncCSVWriter(outputfile_blocked, fieldnames, "w")
+    csv_policy = AsyncCSVWriter(outputfile_policy, fieldnames, "w")
+    csv_error = AsyncCSVWriter(outputfile_error, fieldnames, "w")
+    stat = IOCStat(status_update_interval)
+
+    q = asyncio.Queue()
+
+    # HTTP/2 multiplexes the in-flight lookups over one TLS connection when
+    # the server negotiates h2; httpx falls back to HTTP/1.1 keep-alive
+    # (bounded by the limits below) when it does not.
+    limits = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=15.0,
+                                 headers=AUTH_HEADERS) as session:
+        # Create worker tasks
+        tasks = []
+        for i in range(num_tasks):
+            t = asyncio.ensure_future(worker(session, q, csv_blocked,
+                                             csv_policy, csv_error, stat))
+            tasks.append(t)
+
+        # Open source file and add rows to the queue
+        with open(fname) as csv_file:
+            csv_reader = csv.DictReader(csv_file)
+            for row in csv_reader:
+                if row['ThreatType'] in SUPPORTED_THREAT_TYPES:
+                    q.put_nowait(row)
+                else:
+                    csv_error.write(row)
+                    stat.update({'type': 'error'})
+
+        # Wait for all the items in the queue to be processed
+        await q.join()
+
+        # Shutdown tasks and close files
+        for t in tasks:
+            t.cancel()
+        await csv_blocked.close()
+        await csv_policy.close()
+        await csv_error.close()
+
+    # Create end of line because of the status line
+    print("")
+
+    log(f"Total: {stat.stats()['ioc_total']}, "
+        f"Blocked: {stat.stats()['ioc_blocked']}, "
+        f"Policy: {stat.stats()['ioc_policy']}, "
+        f"Error: {stat.stats()['ioc_error']}")
+
+    # Close statistics task
+    stat.close()
+    log("Finished")
+
+
+def main(argv=sys.argv):
+    p = argparse.ArgumentParser(
+        description='Check risk level for URL, IP and ' +
+        'Domain to exclude already blocked items in the Proxy/WSS Policy',
+        prog='rlcheckaio')
+    p.add_argument('--version', action='version', version='%(prog)s 0.9')
+    p.add_argument('--output-dir', '-f', dest="out", default="output",
+                   help="Output directory")
+    p.add_argument('--tasks', '-t', dest="tasks", type=int, default=64,
+                   help="Concurrent tasks")
+    p.add_argument('--interval', '-i', dest="interval", type=int, default=5,
+                   help="Update interval")
+    p.add_argument('--rate', '-r', dest="rate", type=float,
+                   default=MAX_REQUESTS_PER_SECOND,
+                   help="Max requests per second")
+    p.add_argument('inputfile', help="CSV file with IOC's to check")
+
+    options = p.parse_args()
+
+    # Check for inputfile
+    fname = options.inputfile
+    if not os.path.exists(fname):
+        sys.exit("Invalid input file")
+
+    asyncio.run(run(options, fname))
+
+
+if __name__ == '__main__':
+    main()
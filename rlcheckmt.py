@@ -28,13 +28,32 @@ __status__ = "Development"
 
 import sys
 import os
-import optparse
+import argparse
 import csv
 import datetime
+import urllib.parse
 import dotenv
 import requests
 import queue
 import threading
+import time
+import random
+import logging
+import logging.handlers
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Decode API responses with orjson when available, it is a few times faster
+# than the stdlib parser; fall back to json so it stays a soft dependency.
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
 
 # ------------------------ Application variables ---------------------------- #
 
@@ -46,6 +65,33 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 dotenv.load_dotenv(dotenv_path)
 
 TEX_API_KEY = os.environ.get("TEX_API_KEY")
+if not TEX_API_KEY:
+    sys.exit("TEX_API_KEY not set, create a .env file with the API key")
+
+# Pre-encoded once so urllib3 does not re-encode the header every request
+AUTH_HEADERS = {'Authorization': TEX_API_KEY.encode('ascii')}
+
+# API endpoint, indicators are percent-encoded once at ingest so the
+# request URL is assembled with a plain f-string
+TEX_API_URL = 'https://threatexplorer.symantec.com/api/v1/url'
+
+# One shared session so all worker threads reuse the urllib3 connection pool
+# (keep-alive) instead of a TCP+TLS handshake per IOC. The pool is resized to
+# the number of worker threads in main() via mount_session_adapter().
+SESSION = requests.Session()
+SESSION.headers.update(AUTH_HEADERS)
+
+
+def mount_session_adapter(pool_size):
+    """Size the connection pool to the worker count and set retry policy"""
+    SESSION.mount('https://', HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=5, backoff_factor=0.5,
+                          status_forcelist=[502, 503, 504])))
+
+
+mount_session_adapter(10)
 
 # Threat types that are supported to look up with the API, non supported
 # threat types will go in to the error file.
@@ -54,8 +100,27 @@ SUPPORTED_THREAT_TYPES = ['IP Address', 'Domain', 'URL']
 # Minimum threat level blocked in the WSS/ProxySG policy
 MIN_BLOCKED_RISK_LEVEL = 8
 
+# Client side rate limiting, requests per second and how often a lookup that
+# hit the API limit (HTTP 429) is retried before it goes to the error file.
+MAX_REQUESTS_PER_SECOND = 10
+MAX_RETRIES_429 = 5
+BACKOFF_BASE = 0.5
+
+# Feeds often repeat indicators. Completed lookups are kept for
+# RESULT_CACHE_TTL seconds (bounded to RESULT_CACHE_MAX entries) and a
+# duplicate that arrives while the first lookup is still in flight piggybacks
+# on that request, so no indicator costs a second API call or quota.
+RESULT_CACHE_TTL = 3600
+RESULT_CACHE_MAX = 10000
+
+# On-disk cache so a re-run against an overlapping feed skips the network
+# and the API quota for every indicator seen within the TTL. Disable with
+# --no-cache, tune staleness with --cache-ttl.
+CACHE_FILE = 'rlcheck.cache'
+CACHE_TTL = 86400
+
 # Categories that ar blocked by the policy, categories below for reference
-BLOCKED_CATEGORY_IDS = [17, 18, 43, 44]
+BLOCKED_CATEGORY_IDS = frozenset({17, 18, 43, 44})
 
 # Categories:
 # id name
@@ -148,35 +213,102 @@ BLOCKED_CATEGORY_IDS = [17, 18, 43, 44]
 # ----------------------------- Helper classes ------------------------------ #
 
 
+class RateLimiter:
+    """Token bucket that paces API calls and backs off on HTTP 429"""
+
+    def __init__(self, *args):
+        self.rate = float(args[0])
+        self.capacity = float(args[0])
+        self.tokens = float(args[0])
+        self.timestamp = time.monotonic()
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Block the calling thread until a token is available"""
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens +
+                                      (now - self.timestamp) * self.rate)
+                    self.timestamp = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                self.condition.wait(wait)
+
+    def backoff(self, seconds):
+        """Pause all callers, used when the API reports its limit reached"""
+        with self.condition:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+
+RATE_LIMITER = RateLimiter(MAX_REQUESTS_PER_SECOND)
+
+
 class CSVWriter:
-    """Write CSV files trough a queue"""
+    """Write CSV files trough a queue. The file is only created when the
+    first row arrives, so a run without e.g. blocked IOC's leaves no empty
+    blocked file behind."""
+
+    # Rows buffered before they are handed to the csv module in one call
+    BATCH = 256
 
     def __init__(self, *args):
-        self.filewriter = open(args[0], args[2],
-                               newline='', encoding="utf-8-sig")
-        self.csvwriter = csv.DictWriter(self.filewriter, fieldnames=args[1],
-                                        dialect='excel', delimiter=";")
-        self.csvwriter.writeheader()
+        self.filename = args[0]
+        self.fieldnames = args[1]
+        self.mode = args[2]
+        self.filewriter = None
+        self.csvwriter = None
         self.queue = queue.Queue()
-        self.finished = False
-        threading.Thread(name="CSVWriter", target=self.internal_writer).start()
+        self.thread = threading.Thread(name="CSVWriter",
+                                       target=self.internal_writer)
+        self.thread.start()
 
     def write(self, data):
+        # The file is opened lazily here in the calling thread, so an open
+        # error (e.g. missing output directory) raises at the call site
+        # instead of silently killing the writer thread and deadlocking
+        # close() on queue.join().
+        if self.csvwriter is None:
+            self.openfile()
         self.queue.put(data)
 
+    def openfile(self):
+        self.filewriter = open(self.filename, self.mode, newline='',
+                               encoding="utf-8-sig", buffering=1 << 20)
+        self.csvwriter = csv.writer(self.filewriter,
+                                    dialect='excel', delimiter=";")
+        self.csvwriter.writerow(self.fieldnames)
+
     def internal_writer(self):
-        while not self.finished:
-            try:
-                data = self.queue.get(True, 1)
-                self.csvwriter.writerow(data)
+        # Blocking get with a poison pill instead of the old 1 s polling
+        # loop; rows are collected and flushed per batch to cut syscalls.
+        buf = []
+        while True:
+            data = self.queue.get()
+            if data is None:
                 self.queue.task_done()
-            except queue.Empty:
-                continue
+                break
+            buf.append(data)
+            if len(buf) >= self.BATCH or self.queue.empty():
+                self.csvwriter.writerows(buf)
+                buf.clear()
+            self.queue.task_done()
+        if buf:
+            self.csvwriter.writerows(buf)
 
     def close(self):
         self.queue.join()
-        self.finished = True
-        self.filewriter.close()
+        self.queue.put(None)
+        self.thread.join()
+        if self.filewriter is not None:
+            self.filewriter.close()
 
 
 class IOCStat:
@@ -185,13 +317,11 @@ class IOCStat:
         self.ioc_policy = 0
         self.ioc_error = 0
         self.ioc_total = 0
-        self.printed_stat = 1
         self.queue = queue.Queue()
         self.update_interval = args[0]
-        self.lastoutput = (datetime.datetime.now() -
-                           datetime.timedelta(seconds=60))
         self.finished = False
-        threading.Thread(name="IOCStat", target=self.stat_keeper).start()
+        self.thread = threading.Thread(name="IOCStat", target=self.stat_keeper)
+        self.thread.start()
 
     def update(self, data):
         self.queue.put(data)
@@ -205,18 +335,23 @@ class IOCStat:
         return ret
 
     def stat_keeper(self):
+        # Interval checks use time.monotonic(), far cheaper than datetime
+        # arithmetic, and the line is only redrawn when the counters moved.
+        last = time.monotonic() - self.update_interval
+        last_total = -1
         while not self.finished:
             try:
-                if (datetime.datetime.now() -
-                   self.lastoutput).total_seconds() > self.update_interval:
-                    self.lastoutput = datetime.datetime.now()
-                    sys.stdout.write(f"\r[{self.lastoutput}] "
+                now = time.monotonic()
+                if (now - last > self.update_interval and
+                        self.ioc_total != last_total):
+                    last = now
+                    last_total = self.ioc_total
+                    sys.stdout.write(f"\r[{datetime.datetime.now()}] "
                                      f"Processed: {self.ioc_total}, "
                                      f"Blocked: {self.ioc_blocked}, "
                                      f"Policy: {self.ioc_policy}, "
                                      f"Error: {self.ioc_error}")
                     sys.stdout.flush()
-                    self.printed_stat = 1
 
                 data = self.queue.get(True, 1)
                 if data['type'] == 'blocked':
@@ -233,28 +368,129 @@ class IOCStat:
     def close(self):
         self.queue.join()
         self.finished = True
+        self.thread.join()
+
+
+# Worker threads log through a queue so they never serialize on terminal
+# I/O; a single listener thread drains the queue and writes to stderr,
+# keeping stdout free for the status line.
+logger = logging.getLogger('rlcheck')
+logger.propagate = False
+
+
+def setup_logging():
+    """Start the queue-based log pipeline and return the listener"""
+    log_q = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter('[%(asctime)s] %(message)s'))
+    listener = logging.handlers.QueueListener(log_q, stream)
+    logger.addHandler(logging.handlers.QueueHandler(log_q))
+    logger.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
+
+# Column indices of the required fields, set in main() from the CSV header.
+# Rows travel through the queue and the writers as plain lists so the
+# C-accelerated csv reader/writer is used instead of the dict wrappers.
+idx_indicator = 0
+idx_threattype = 0
+
+_INFLIGHT = {}
+_RESULTS = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+# Disk cache state, sqlite3 connections are not thread safe so each worker
+# gets its own connection via threading.local()
+cache_enabled = True
+cache_ttl = CACHE_TTL
+_cache_local = threading.local()
+
+
+def cache_connection():
+    """Return this thread's connection to the cache database"""
+    conn = getattr(_cache_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(CACHE_FILE, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS rlcheck ('
+                     'indicator TEXT PRIMARY KEY, ts INTEGER, '
+                     'risklevel INT, blocked INT, categories TEXT)')
+        _cache_local.conn = conn
+    return conn
+
+
+def cache_get(ioc):
+    """Return the cached result for an IOC, or None when absent or stale"""
+    row = cache_connection().execute(
+        'SELECT ts, risklevel, blocked, categories FROM rlcheck '
+        'WHERE indicator = ?', (ioc,)).fetchone()
+    if row is None or time.time() - row[0] > cache_ttl:
+        return None
+    ret = dict()
+    ret['error'] = 0
+    ret['risklevel'] = row[1]
+    ret['blocked'] = row[2]
+    ret['category'] = row[3].split(', ') if row[3] else []
+    return ret
 
 
-def log(message):
-    ts = datetime.datetime.now()
-    print(f"[{ts}] {message}")
+def cache_put(ioc, ret):
+    """Store a successful lookup in the cache database"""
+    cache_connection().execute(
+        'INSERT OR REPLACE INTO rlcheck VALUES (?, ?, ?, ?, ?)',
+        (ioc, int(time.time()), ret['risklevel'], ret['blocked'],
+         ', '.join(ret['category'])))
 
 
-# Initialize multi threading variables and the queue used for the IOC's
-num_worker_threads = 0
-status_update_interval = 0
-q = queue.Queue()
-threads = []
-status_output = 0
+def rlcheck(ioc):
+    """Look up an IOC, coalescing duplicates and caching recent results"""
+
+    with _CACHE_LOCK:
+        cached = _RESULTS.get(ioc)
+        if (cached is not None and
+                time.monotonic() - cached[0] < RESULT_CACHE_TTL):
+            return cached[1]
+        fut = _INFLIGHT.get(ioc)
+        if fut is not None:
+            owner = False
+        else:
+            fut = Future()
+            _INFLIGHT[ioc] = fut
+            owner = True
 
+    if not owner:
+        # Another worker is already looking this IOC up, wait for its result
+        return fut.result()
 
-def rlcheck(ioc):
+    try:
+        ret = cache_get(ioc) if cache_enabled else None
+        if ret is None:
+            ret = _do_rlcheck(ioc)
+            if cache_enabled and ret['error'] == 0:
+                cache_put(ioc, ret)
+    except BaseException as e:
+        with _CACHE_LOCK:
+            _INFLIGHT.pop(ioc, None)
+        fut.set_exception(e)
+        raise
+
+    with _CACHE_LOCK:
+        # Only successful lookups are memoized, an error (timeout, exhausted
+        # 429) must not fail later duplicates straight from cache
+        if ret['error'] == 0:
+            _RESULTS[ioc] = (time.monotonic(), ret)
+            while len(_RESULTS) > RESULT_CACHE_MAX:
+                _RESULTS.popitem(last=False)
+        _INFLIGHT.pop(ioc, None)
+    fut.set_result(ret)
+    return ret
+
+
+def _do_rlcheck(ioc):
     """Return risklevel, categories and if it is blocked by policy"""
 
-    # Set authentication based on value in .env file.
-    auth_headers = {'Authorization': TEX_API_KEY}
-    tex_api_url = 'https://threatexplorer.symantec.com/api/v1/url' + \
-                  '?level=STANDARD&url='
     # Initialize return object
     ret = dict()
     ret['error'] = 0
@@ -262,16 +498,37 @@ def rlcheck(ioc):
     ret['risklevel'] = 0
     ret['category'] = []
 
-    try:
-        response = requests.get(tex_api_url + ioc, headers=auth_headers)
-    except requests.exceptions.RequestException as e:
-        ret['error'] = e
+    # Pace the request through the token bucket and retry 429 responses with
+    # exponential backoff and jitter instead of losing the IOC to the error
+    # file. The API's Retry-After header caps the backoff when present.
+    for attempt in range(MAX_RETRIES_429 + 1):
+        RATE_LIMITER.acquire()
+        try:
+            response = SESSION.get(
+                f"{TEX_API_URL}?level=STANDARD&url={ioc}",
+                timeout=(3, 10))
+        except requests.exceptions.RequestException as e:
+            ret['error'] = e
+            return ret
+
+        if response.status_code != 429:
+            break
+
+        backoff = BACKOFF_BASE * 2 ** attempt + random.random()
+        retry_after = response.headers.get(
+            'Retry-After', response.headers.get('X-RateLimit-Reset'))
+        if retry_after is not None:
+            try:
+                backoff = min(float(retry_after), backoff)
+            except ValueError:
+                pass
+        RATE_LIMITER.backoff(backoff)
 
     if (response.status_code == 200):
         ret['error'] = 0
         ret['blocked'] = 0
         ret['category'] = []
-        data = response.json()
+        data = _loads(response.content)
 
         if "categorization" in data and "categories" in data["categorization"]:
             categories = data["categorization"]["categories"]
@@ -303,74 +560,90 @@ def rlcheck(ioc):
     return ret
 
 
-def do_work(item, csv_blocked, csv_policy, csv_error, stat):
-    """Look up IOC, augment with api data and write it to the correct file"""
+def process_row(args):
+    """Look up an IOC and return which output file the row belongs in"""
+
+    item, ioc_q = args
+    if item[idx_threattype] not in SUPPORTED_THREAT_TYPES:
+        return ('error', item + ['', ''])
 
     try:
-        ret = rlcheck(item["Indicator"])
+        ret = rlcheck(ioc_q)
     except Exception as e:
-        ret = []
+        ret = dict()
         ret['error'] = e
 
-    categories = ""
     if ret['error'] != 0:
-        if stat.printed_stat == 1:
-            print("")
-            stat.printed_stat = 0
-        log(f"Error {ret['error']} while processing {item['Indicator']}")
-        stat.update({'type': 'error'})
-        csv_error.write(item)
-    else:
-        for cat in ret['category']:
-            if categories == "":
-                categories = cat
-            else:
-                categories += ', ' + cat
-        item.update({'BC_RiskLevel': ret['risklevel'],
-                    'BC_Category': categories})
-        if ret['blocked'] == 1:
-            csv_blocked.write(item)
-            stat.update({'type': 'blocked'})
-        else:
-            csv_policy.write(item)
-            stat.update({'type': 'policy'})
-
-
-def worker(shutdown_event, csv_blocked, csv_policy, csv_error, stat):
-    """Process IOC from queue and start processing them"""
-    while not shutdown_event.is_set():
-        try:
-            item = q.get(block=True, timeout=0.05)
-            do_work(item, csv_blocked, csv_policy, csv_error, stat)
-            q.task_done()
-        except queue.Empty:
-            continue
+        logger.info(f"Error {ret['error']} while processing "
+                    f"{item[idx_indicator]}")
+        return ('error', item + ['', ''])
+
+    item = item + [ret['risklevel'], ', '.join(ret['category'])]
+    if ret['blocked'] == 1:
+        return ('blocked', item)
+    return ('policy', item)
+
+
+def iter_rows(fname):
+    """Yield (row, percent-encoded indicator) pairs from the input file.
+    Quoting once at ingest means the workers do zero encoding work and
+    indicators containing '?', '&', '#' or spaces no longer break or
+    silently mis-address the API call."""
+    with open(fname, encoding='utf-8-sig', buffering=1 << 20,
+              newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        next(csv_reader, None)
+        for row in csv_reader:
+            # csv.reader yields [] for blank lines (DictReader used to skip
+            # them); drop rows too short to hold the required columns
+            if len(row) <= max(idx_indicator, idx_threattype):
+                continue
+            yield (row, urllib.parse.quote(row[idx_indicator], safe=''))
 
 
 def main(argv=sys.argv):
-    p = optparse.OptionParser(
+    p = argparse.ArgumentParser(
         description='Check risk level for URL, IP and ' +
         'Domain to exclude already blocked items in the Proxy/WSS Policy',
-        prog='rlcheck',
-        version='0.9',
-        usage='%prog <input file>')
-    p.add_option('--output-dir', '-f', dest="out", help="Output directory")
-    p.set_default("out", "output")
-    p.add_option('--threads', '-t', dest="threads", help="Concurrent threads")
-    p.set_default("threads", 10)
-    p.add_option('--interval', '-i', dest="interval", help="Update interval")
-    p.set_default("interval", 5)
-
-    options, arguments = p.parse_args()
-
-    if len(arguments) != 1:
-        p.error("Incorrect arguments")
-
-    num_worker_threads = int(options.threads)
-    status_update_interval = int(options.interval)
+        prog='rlcheck')
+    p.add_argument('--version', action='version', version='%(prog)s 0.9')
+    p.add_argument('--output-dir', '-f', dest="out", default="output",
+                   help="Output directory")
+    p.add_argument('--threads', '-t', dest="threads", type=int, default=10,
+                   help="Concurrent threads")
+    p.add_argument('--interval', '-i', dest="interval", type=int, default=5,
+                   help="Update interval")
+    p.add_argument('--rate', '-r', dest="rate", type=float,
+                   default=MAX_REQUESTS_PER_SECOND,
+                   help="Max requests per second")
+    p.add_argument('--no-cache', dest="nocache", action='store_true',
+                   help="Bypass the on-disk result cache")
+    p.add_argument('--cache-ttl', dest="cachettl", type=int,
+                   default=CACHE_TTL,
+                   help="Seconds before a cached result is stale")
+    p.add_argument('inputfile', help="CSV file with IOC's to check")
+
+    options = p.parse_args()
+
+    listener = setup_logging()
+
+    num_worker_threads = options.threads
+    status_update_interval = options.interval
+
+    # Resize the connection pool so every worker thread can keep a socket
+    mount_session_adapter(num_worker_threads)
+
+    # Apply the requested rate limit to the shared token bucket
+    RATE_LIMITER.rate = options.rate
+    RATE_LIMITER.capacity = options.rate
+
+    # Configure the on-disk result cache
+    global cache_enabled, cache_ttl
+    cache_enabled = not options.nocache
+    cache_ttl = options.cachettl
 
     # Check for inputfile
-    fname = arguments[0]
+    fname = options.inputfile
     if not os.path.exists(fname):
         sys.exit("Invalid input file")
 
@@ -389,26 +662,31 @@ def main(argv=sys.argv):
         outpath, ts + '_error' + '_' + os.path.basename(fname))
 
     # Get fieldnames from inputfile and add api return fields
-    with open(fname, encoding='utf-8-sig') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-
-        for row in csv_reader:
-            fieldnames = row
-            fieldnames.update({'BC_RiskLevel': '',
-                               'BC_Category': ''})
-            if not ('Indicator' in fieldnames):
-                log(f'Unable to find the column Indicator in {fname}')
-                return
-            if not ('ThreatType' in fieldnames):
-                log(f'Unable to find the column ThreatType in {fname}')
-                return
-            break
-        # go to begining of file to count IOC's (minus header)
-        csv_file.seek(0)
-        ioccount = len(list(csv_reader)) - 1
-
-    log(f"Checking {ioccount} IOC's in {fname} "
-        f"with {num_worker_threads} threads...")
+    global idx_indicator, idx_threattype
+    with open(fname, encoding='utf-8-sig', buffering=1 << 20,
+              newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader, None)
+
+        if header is None or 'Indicator' not in header:
+            logger.info(f"Unable to find the column Indicator in {fname}")
+            return
+        if 'ThreatType' not in header:
+            logger.info(f"Unable to find the column ThreatType in {fname}")
+            return
+        idx_indicator = header.index('Indicator')
+        idx_threattype = header.index('ThreatType')
+        fieldnames = header + ['BC_RiskLevel', 'BC_Category']
+
+    # Count IOC's (minus header) by scanning the raw bytes for newlines
+    # instead of materializing the whole file through the csv module again
+    ioccount = -1
+    with open(fname, 'rb') as rawfile:
+        for chunk in iter(lambda: rawfile.read(1 << 20), b''):
+            ioccount += chunk.count(b'\n')
+
+    logger.info(f"Checking {ioccount} IOC's in {fname} "
+                f"with {num_worker_threads} threads...")
 
     # Create threading save outputfile writers
     csv_blocked = CSVWriter(outputfile_blocked, fieldnames, "w")
@@ -416,33 +694,31 @@ def main(argv=sys.argv):
     csv_error = CSVWriter(outputfile_error, fieldnames, "w")
     stat = IOCStat(status_update_interval)
 
-    shutdown_event = threading.Event()
-
-    # Create worker threads
-    for i in range(num_worker_threads):
-        t = threading.Thread(target=worker, args=(shutdown_event,
-                                                  csv_blocked,
-                                                  csv_policy,
-                                                  csv_error,
-                                                  stat))
-        t.start()
-        threads.append(t)
-
-    # Open source file and add rows to the queue
-    with open(fname) as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            if row['ThreatType'] in SUPPORTED_THREAT_TYPES:
-                q.put(row)
-            else:
-                csv_error.write(row)
-                stat.update({'type': 'error'})
-
-    # Wait for all the items in the queue to be processed
-    q.join()
-
-    # Shutdown threads and close files
-    shutdown_event.set()
+    def dispatch(result):
+        kind, row = result
+        if kind == 'blocked':
+            csv_blocked.write(row)
+        elif kind == 'policy':
+            csv_policy.write(row)
+        else:
+            csv_error.write(row)
+        stat.update({'type': kind})
+
+    # Submit rows in a bounded window (Executor.map would eagerly create a
+    # future per row, materializing the whole input up front); draining the
+    # oldest future once the window is full keeps the rows in input order
+    # and applies real backpressure against the file.
+    window = num_worker_threads * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_worker_threads) as executor:
+        for args in iter_rows(fname):
+            pending.append(executor.submit(process_row, args))
+            while len(pending) >= window:
+                dispatch(pending.popleft().result())
+        while pending:
+            dispatch(pending.popleft().result())
+
+    # Close files, close() joins each writer thread
     csv_blocked.close()
     csv_policy.close()
     csv_error.close()
@@ -450,19 +726,16 @@ def main(argv=sys.argv):
     # Create end of line because of the status line
     print("")
 
-    log(f"Total: {stat.stats()['ioc_total']}, "
-        f"Blocked: {stat.stats()['ioc_blocked']}, "
-        f"Policy: {stat.stats()['ioc_policy']}, "
-        f"Error: {stat.stats()['ioc_error']}")
+    logger.info(f"Total: {stat.stats()['ioc_total']}, "
+                f"Blocked: {stat.stats()['ioc_blocked']}, "
+                f"Policy: {stat.stats()['ioc_policy']}, "
+                f"Error: {stat.stats()['ioc_error']}")
 
     # Close statistics thread
     stat.close()
 
-    if threading.active_count() > 1:
-        log("Waiting for threads to finish...")
-    while threading.active_count() > 1:
-        continue
-    log("Finished")
+    logger.info("Finished")
+    listener.stop()
 
 
 if __name__ == '__main__':